@@ -1,19 +1,51 @@
+import bisect
+import hashlib
+import logging
 import os
+import pickle
 import requests
 import time
 import traceback
 import uuid
-from collections import defaultdict
+from collections import OrderedDict
 from functools import wraps
 from getpass import getuser
-from threading import Thread
+from queue import Empty, Queue
+from threading import Lock, Thread, local
+from weakref import WeakValueDictionary
 
 import ftrack_api
 from Qt import QtCore, QtGui, QtWidgets
 from vfxwindow import VFXWindow
 
 
+def _logLevel(name, default=logging.INFO):
+    """Get a logging level from its name or number."""
+    if name.isdigit():
+        return int(name)
+    level = logging.getLevelName(name.upper())
+    if isinstance(level, int):
+        return level
+    return default
+
+
+logger = logging.getLogger('ftrack_api_explorer')
+logger.setLevel(_logLevel(os.environ.get('FTRACK_EXPLORER_LOG', 'INFO')))
+
 _ID_REMAP = {}
+_TASKS = None
+_MAX_WORKERS = 4
+_BATCH_SIZE = 32
+_THREAD_DATA = local()
+_SESSIONS = []
+_SESSION_LOCK = Lock()
+_SESSIONS_CLOSED = False
+
+
+def hasCredentials():
+    """Determine if the environment is set up to connect to FTrack."""
+    credentials = ('FTRACK_SERVER', 'FTRACK_API_KEY', 'FTRACK_API_USER')
+    return all(key in os.environ for key in credentials)
 
 
 def remapID(entityID):
@@ -30,6 +62,50 @@ def remapID(entityID):
     return newID
 
 
+def ftrackSession():
+    """Get the ftrack session belonging to the current thread.
+    Sessions are not thread safe, so each thread gets its own one, which
+    is then kept open to avoid connecting again for every query.
+    """
+    session = getattr(_THREAD_DATA, 'session', None)
+    if session is None or session.closed:
+        with _SESSION_LOCK:
+            if _SESSIONS_CLOSED:
+                raise RuntimeError('unable to create a session after closing')
+            session = _THREAD_DATA.session = ftrack_api.Session()
+            _SESSIONS.append(session)
+    return session
+
+
+def resetSession():
+    """Close the session of the current thread.
+    This forces a new one to be created with the latest credentials.
+    """
+    session = getattr(_THREAD_DATA, 'session', None)
+    if session is None:
+        return
+    del _THREAD_DATA.session
+    with _SESSION_LOCK:
+        try:
+            _SESSIONS.remove(session)
+        except ValueError:
+            pass
+    session.close()
+
+
+def closeSessions():
+    """Close all the sessions that are still open.
+    No new sessions can be created until the workers are restarted.
+    """
+    global _SESSIONS_CLOSED
+    with _SESSION_LOCK:
+        _SESSIONS_CLOSED = True
+        sessions = list(_SESSIONS)
+        del _SESSIONS[:]
+    for session in sessions:
+        session.close()
+
+
 def errorHandler(func):
     """Catch any exception and emit it as a signal."""
     @wraps(func)
@@ -38,6 +114,11 @@ def errorHandler(func):
             return func(self, *args, **kwargs)
 
         except Exception as e:
+            # Any jobs still running after closing are expected to fail
+            if _SESSIONS_CLOSED:
+                logger.debug('Ignoring error after sessions were closed: %s', e)
+                return None
+
             try:
                 error = str(e)
             except KeyError:
@@ -49,16 +130,19 @@ def errorHandler(func):
             if isinstance(e, ftrack_api.exception.ServerError):
                 error = error[23:]  # Remove "Server reported error"
                 if 'ftrack-user' in error:
+                    resetSession()
                     try:
                         del os.environ['FTRACK_API_USER']
                     except KeyError:
                         pass
                 if 'ftrack-api-key' in error:
+                    resetSession()
                     try:
                         del os.environ['FTRACK_API_KEY']
                     except KeyError:
                         pass
             if isinstance(e, requests.exceptions.ConnectionError):
+                resetSession()
                 try:
                     del os.environ['FTRACK_SERVER']
                 except KeyError:
@@ -74,16 +158,81 @@ def errorHandler(func):
     return wrapper
 
 
+def _worker(tasks):
+    """Run deferred functions from the queue until told to stop."""
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        func, args, kwargs = task
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception('Error in %s', func.__name__)
+
+
+def taskQueue():
+    """Get the queue used to run deferred functions.
+    The workers are daemon threads, so that exiting never waits on a
+    request, as they have no timeout.
+    This is created on demand so that it can be restarted if the
+    window is reopened after being closed.
+    """
+    global _TASKS, _SESSIONS_CLOSED
+    if _TASKS is None:
+        with _SESSION_LOCK:
+            _SESSIONS_CLOSED = False
+        _TASKS = Queue()
+        for i in range(_MAX_WORKERS):
+            Thread(target=_worker, args=(_TASKS,), name=f'ftrack-explorer_{i}', daemon=True).start()
+    return _TASKS
+
+
+def stopWorkers():
+    """Stop the worker threads and discard anything not yet started.
+    Anything already running is left to finish in the background.
+    """
+    global _TASKS
+    if _TASKS is None:
+        return
+    while True:
+        try:
+            _TASKS.get_nowait()
+        except Empty:
+            break
+    for _ in range(_MAX_WORKERS):
+        _TASKS.put(None)
+    _TASKS = None
+
+
 def deferred(func):
-    """Run a function in a thread."""
+    """Run a function in one of the worker threads."""
+    @wraps(func)
     def wrapper(*args, **kwargs):
-        thread = Thread(target=func, args=args, kwargs=kwargs)
-        thread.daemon = True
-        thread.start()
-        return thread
+        taskQueue().put((func, args, kwargs))
     return wrapper
 
 
+def _progressStep(total, updates=20):
+    """Get how often to report progress to avoid flooding the GUI."""
+    return max(1, total // updates)
+
+
+def cachePath():
+    """Get where to save the cache for the current server and user.
+    Returns None if there is nowhere to save it.
+    """
+    server = os.environ.get('FTRACK_SERVER')
+    user = os.environ.get('FTRACK_API_USER')
+    if not server or not user:
+        return None
+    folder = QtCore.QStandardPaths.writableLocation(QtCore.QStandardPaths.CacheLocation)
+    if not folder:
+        return None
+    name = hashlib.md5(f'{user}@{server}'.encode('utf-8')).hexdigest()
+    return os.path.join(folder, 'ftrack-api-explorer', f'{name}.pickle')
+
+
 def entityRepr(entityType, entityID=None, remapIDs=False):
     """Create a correct representation of an entity.
     >>> project = session.query('Project').first()
@@ -95,26 +244,109 @@ def entityRepr(entityType, entityID=None, remapIDs=False):
     if entityID is None:
         entity, entityType = entityType, type(entityType)
 
-    primaryKeys = entityType.primary_key_attributes
+    info = TypeInfo.get(entityType)
+    keys = info.primaryKeys
+
+    # Skip building the arguments if there's only a single primary key
+    if len(keys) == 1:
+        key = keys[0]
+        if entityID is None:
+            entityID = entity[key]
+        elif isinstance(entityID, (list, tuple)):
+            entityID = entityID[0]
+        if remapIDs:
+            entityID = remapID(entityID)
+        return info.reprFormat.format(entityID)
 
     if entityID is None:
-        entityID = [entity[k] for k in primaryKeys]
+        entityID = [entity[k] for k in keys]
     elif not isinstance(entityID, (list, tuple)):
         entityID = [entityID]
 
     # Generate an accurate representation of the entity
     if remapIDs:
         entityID = map(remapID, entityID)
-    args = ', '.join(f'{k}={v!r}' for k, v in zip(primaryKeys, entityID))
-    return f'{entityType.entity_type}({args})'
+    return info.reprFormat.format(*entityID)
 
 
 def isKeyLoaded(entity, key):
     """Determine if an entity has a key loaded."""
-    attrStorage = getattr(entity, '_ftrack_attribute_storage')
-    if attrStorage is None or key not in attrStorage:
+    attrStorage = entity.__dict__.get('_ftrack_attribute_storage')
+    if not attrStorage:
         return False
-    return attrStorage[key]['remote'] != ftrack_api.symbol.NOT_SET
+    value = attrStorage.get(key)
+    return value is not None and value['remote'] is not ftrack_api.symbol.NOT_SET
+
+
+def populateKeys(entity, keys):
+    """Load multiple keys of an entity with a single query.
+    Collections are skipped as they are only loaded once expanded.
+    Returns False if the server was unable to load the keys.
+    """
+    kinds = TypeInfo.get(type(entity)).kinds
+    projections = []
+    for key in keys:
+        if isKeyLoaded(entity, key):
+            continue
+        if kinds.get(key) in TypeInfo.Collections:
+            continue
+        projections.append(key)
+
+    if not projections:
+        return True
+    try:
+        entity.session.populate(entity, ', '.join(projections))
+    except ftrack_api.exception.ServerError:
+        return False
+    return True
+
+
+class TypeInfo(object):
+    """Cache the schema details of an entity type.
+    The entity classes are generated per session, so each one gets its
+    own instance.
+    """
+
+    __slots__ = ('name', 'kinds', 'primaryKeys', 'sortedKeys', 'reprFormat')
+    Types = {}
+
+    Scalar = 0
+    Reference = 1
+    Collection = 2
+    MappedCollection = 3
+    Collections = (Collection, MappedCollection)
+
+    def __init__(self, entityType):
+        self.name = entityType.entity_type
+        attributes = entityType.attributes
+        self.primaryKeys = tuple(map(str, entityType.primary_key_attributes))
+        self.sortedKeys = tuple(sorted(attributes.keys()))
+
+        # Check the attribute types once rather than for every entity
+        self.kinds = {}
+        for key in self.sortedKeys:
+            attr = attributes.get(key)
+            if isinstance(attr, ftrack_api.attribute.ReferenceAttribute):
+                self.kinds[key] = self.Reference
+            elif isinstance(attr, ftrack_api.attribute.CollectionAttribute):
+                self.kinds[key] = self.Collection
+            elif isinstance(attr, ftrack_api.attribute.KeyValueMappedCollectionAttribute):
+                self.kinds[key] = self.MappedCollection
+            else:
+                self.kinds[key] = self.Scalar
+
+        # Build the template used by `entityRepr`
+        args = ', '.join(f'{k}={{!r}}' for k in self.primaryKeys)
+        self.reprFormat = f'{self.name}({args})'
+
+    @classmethod
+    def get(cls, entityType):
+        """Get the details of an entity type."""
+        try:
+            return cls.Types[entityType]
+        except KeyError:
+            info = cls.Types[entityType] = cls(entityType)
+        return info
 
 
 class BusyProgressBar(QtWidgets.QWidget):
@@ -150,8 +382,8 @@ class BusyProgressBar(QtWidgets.QWidget):
 
 class Placeholders(object):
     """Fake classes to use as placeholders.
-    The purpose of this is for the dummy items, so they can be replaced
-    once the parent item is expanded.
+    The purpose of this is for the unloaded items, so they can be
+    populated once the parent item is expanded.
     """
 
     class Collection(object):
@@ -161,13 +393,40 @@ class Placeholders(object):
         pass
 
 
+class ContainerValue(object):
+    """Store a list or dict on an item until it is expanded.
+    Wrapping the value stops Qt from converting it.
+    """
+
+    __slots__ = ('value', 'entity')
+
+    def __init__(self, value, entity):
+        self.value = value
+        self.entity = entity
+
+    def items(self):
+        """Get the keys and values in the order they should be shown."""
+        if isinstance(self.value, dict):
+            return [(k, self.value[k]) for k in sorted(self.value)]
+        return [(str(i), v) for i, v in enumerate(self.value)]
+
+
 class EntityCache(object):
-    """Cache entity values."""
+    """Cache entity values.
+    The values are stored in a shared LRU cache keyed by the entity ID
+    and key, so that the memory usage is capped.
+    Entities are only weakly referenced, as their sessions already keep
+    hold of them for as long as they are open.
+    """
 
     __slots__ = ('id',)
-    Cache = defaultdict(dict)
-    Entities = {}
-    Types = {}
+    Cache = OrderedDict()
+    CacheSize = 10000
+    CacheLock = Lock()
+    CacheTimes = {}
+    CacheExpiry = 60 * 60 * 24
+    Entities = WeakValueDictionary()
+    TypeNames = []
 
     def __init__(self, entity, remapIDs=False):
         self.id = entityRepr(entity, remapIDs=remapIDs)
@@ -177,53 +436,196 @@ class EntityCache(object):
             self.Entities[self.id] = entity
 
     def __getitem__(self, key):
-        return self.cache[key]
+        with self.CacheLock:
+            self.Cache.move_to_end((self.id, key))
+            return self.Cache[(self.id, key)]
 
     def __setitem__(self, key, value):
-        self.cache[key] = value
+        with self.CacheLock:
+            self.Cache[(self.id, key)] = value
+            self.Cache.move_to_end((self.id, key))
+
+            # A fresh value no longer needs to expire with the disk cache
+            if self.CacheTimes:
+                self.CacheTimes.pop((self.id, key), None)
+
+            # Remove the least recently used values
+            while len(self.Cache) > self.CacheSize:
+                self.CacheTimes.pop(self.Cache.popitem(last=False)[0], None)
 
     def __contains__(self, key):
-        return key in self.cache
+        return (self.id, key) in self.Cache
 
-    @property
-    def cache(self):
-        return self.Cache[self.id]
+    def isExpired(self, key):
+        """Determine if a value from a previous session is too old to use."""
+        cacheTime = self.CacheTimes.get((self.id, key))
+        return cacheTime is not None and cacheTime < time.time() - self.CacheExpiry
+
+    def get(self, key, default=None):
+        """Get a cached value with a single lookup."""
+        cacheKey = (self.id, key)
+        with self.CacheLock:
+            try:
+                self.Cache.move_to_end(cacheKey)
+            except KeyError:
+                return default
+            return self.Cache[cacheKey]
 
     @classmethod
     def reset(cls):
         """Remove all cache."""
-        cls.Cache = defaultdict(dict)
+        with cls.CacheLock:
+            cls.Cache.clear()
+            cls.CacheTimes.clear()
+
+    @classmethod
+    def saveToDisk(cls, path):
+        """Save the cached values so they can be reused next time.
+        Entities and collections are skipped as they belong to a session.
+        Any values loaded from disk keep their original time, so that
+        they still expire, and any unexpired values already saved that
+        weren't loaded this time are kept.
+        """
+        skipTypes = (
+            ftrack_api.entity.base.Entity,
+            ftrack_api.collection.Collection,
+            ftrack_api.collection.KeyValueMappedCollectionProxy,
+            Placeholders.Collection,
+            Placeholders.KeyValueMappedCollectionProxy,
+        )
+        with cls.CacheLock:
+            items = list(cls.Cache.items())
+
+        now = time.time()
+        data = {}
+        for cacheKey, value in items:
+            if isinstance(value, skipTypes):
+                continue
+            try:
+                data[cacheKey] = (cls.CacheTimes.get(cacheKey, now), pickle.dumps(value))
+            except (pickle.PicklingError, AttributeError, TypeError):
+                continue
+
+        # Keep anything from previous sessions that wasn't loaded this time
+        entries = cls._readDisk(path)
+        if entries is None:
+            logger.warning('Not saving cache as %r could not be read', path)
+            return
+        for cacheKey, cacheTime, value in entries:
+            if len(data) >= cls.CacheSize:
+                break
+            data.setdefault(cacheKey, (cacheTime, value))
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f'{path}.tmp', 'wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f'{path}.tmp', path)
+        except OSError as e:
+            logger.warning('Failed to save cache to %r: %s', path, e)
+        else:
+            logger.debug('Saved %d cached values to %r', len(data), path)
+
+    @classmethod
+    def _readDisk(cls, path):
+        """Read the unexpired entries from a cache file.
+        Returns a list of (cacheKey, time, pickled value) items, or None
+        if the file exists but could not be read.
+        """
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+            entries = [(cacheKey, float(cacheTime), value)
+                       for cacheKey, (cacheTime, value) in data.items()]
+            if not all(isinstance(entry[2], bytes) for entry in entries):
+                raise TypeError('cached values must be pickled')
+        except FileNotFoundError:
+            return []
+
+        # The file may be readable later, so leave it alone
+        except OSError as e:
+            logger.warning('Failed to read cache %r: %s', path, e)
+            return None
+
+        # Treat an invalid file as a cache miss and start again
+        except (pickle.UnpicklingError, EOFError, ValueError, TypeError,
+                AttributeError, ImportError, IndexError, KeyError) as e:
+            logger.warning('Discarding invalid cache %r: %s', path, e)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return []
+
+        expiry = time.time() - cls.CacheExpiry
+        return [entry for entry in entries if entry[1] >= expiry]
+
+    @classmethod
+    def loadFromDisk(cls, path):
+        """Load any cached values that have not yet expired.
+        Values already in the cache are not overwritten.
+        """
+        entries = cls._readDisk(path)
+        if not entries:
+            return
+
+        count = 0
+        with cls.CacheLock:
+            for cacheKey, cacheTime, value in entries:
+                if cacheKey in cls.Cache:
+                    continue
+                try:
+                    cls.Cache[cacheKey] = pickle.loads(value)
+                except Exception:
+                    continue
+                cls.CacheTimes[cacheKey] = cacheTime
+                count += 1
+
+            # The newest values are kept as they were added last
+            while len(cls.Cache) > cls.CacheSize:
+                cls.CacheTimes.pop(cls.Cache.popitem(last=False)[0], None)
+        logger.debug('Loaded %d cached values from %r', count, path)
 
     @classmethod
     def load(cls, entity, remapIDs=False):
-        """Add an entity to cache."""
+        """Add an entity to cache.
+        Any referenced entities are only registered so they can be found
+        later, and their own values get cached once they are expanded.
+        """
         cache = cls(entity, remapIDs=remapIDs)
-        attributes = type(entity).attributes
+        attrStorage = entity.__dict__.get('_ftrack_attribute_storage')
+        if not attrStorage:
+            return
+
+        # This is the same check as isKeyLoaded, but done inline
+        getKind = TypeInfo.get(type(entity)).kinds.get
+        getStorage = attrStorage.get
+        notSet = ftrack_api.symbol.NOT_SET
         for key in entity.keys():
-            if not isKeyLoaded(entity, key):
+            data = getStorage(key)
+            if data is None or data['remote'] is notSet:
                 continue
 
-            cache[key] = entity[key]
-            attr = attributes.get(key)
-            if isinstance(attr, ftrack_api.attribute.ReferenceAttribute):
-                cls.load(entity[key])
-            elif isinstance(attr, ftrack_api.attribute.CollectionAttribute):
-                for child in entity[key]:
-                    cls.load(child)
+            value = cache[key] = entity[key]
+            kind = getKind(key)
+            if kind == TypeInfo.Reference:
+                if value is not None:
+                    cls(value, remapIDs=remapIDs)
+            elif kind == TypeInfo.Collection:
+                for child in value:
+                    cls(child, remapIDs=remapIDs)
 
     @classmethod
-    @errorHandler
-    def types(cls, session=None):
-        """Cache the entity types to avoid opening more sessions."""
-        if not cls.Types:
-            print('Loading FTrack entity types...')
-            if session is not None:
-                cls.Types = session.types
-            else:
-                with ftrack_api.Session() as session:
-                    cls.Types = session.types
-                    return dict(cls.Types)
-        return dict(cls.Types)
+    def typeNames(cls, session=None):
+        """Get the sorted names of all the entity types.
+        These are cached to avoid fetching the schema again.
+        """
+        if not cls.TypeNames:
+            logger.info('Loading FTrack entity types...')
+            if session is None:
+                session = ftrackSession()
+            cls.TypeNames = sorted(session.types)
+        return cls.TypeNames
 
     @classmethod
     def entity(cls, name):
@@ -231,50 +633,111 @@ class EntityCache(object):
         return cls.Entities.get(name)
 
 
+class EntityModel(QtGui.QStandardItemModel):
+    """Item model that only loads children once they are needed.
+    Items marked as unloaded report that they have children without
+    needing any placeholder rows, and the view will request them with
+    `fetchMore` when the item is expanded.
+    """
+
+    UnloadedRole = QtCore.Qt.UserRole
+
+    fetchRequested = QtCore.Signal(QtCore.QModelIndex)
+
+    def hasChildren(self, parent=QtCore.QModelIndex()):
+        """Assume lazy loaded items have children."""
+        if self.data(parent, self.UnloadedRole) is not None:
+            return True
+        return super().hasChildren(parent)
+
+    def canFetchMore(self, parent):
+        """Determine if an item has not yet been loaded."""
+        return bool(self.data(parent, self.UnloadedRole))
+
+    def fetchMore(self, parent):
+        """Request the children of an item to be loaded."""
+        if not self.canFetchMore(parent):
+            return
+        self.setData(parent, False, self.UnloadedRole)
+        self.fetchRequested.emit(parent)
+
+    def itemFromPersistentIndex(self, index):
+        """Get the item of a persistent index.
+        Returns None if the item has since been removed.
+        """
+        if not index.isValid():
+            return None
+        return self.itemFromIndex(self.index(index.row(), index.column(), index.parent()))
+
+
 class QueryEdit(QtWidgets.QLineEdit):
     """Add a few features to the line edit widget."""
+
+    typesRequested = QtCore.Signal()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.setPlaceholderText('Type custom query here...')
-        self._completerSet = False
+        self._typesRequested = False
+        self._completionRequested = False
 
-    def setupCompleter(self):
-        if self._completerSet:
-            return False
         completer = QtWidgets.QCompleter()
         completer.setCaseSensitivity(QtCore.Qt.CaseInsensitive)
+        completer.setModel(QtCore.QStringListModel())
         self.setCompleter(completer)
-        model = QtCore.QStringListModel()
-        completer.setModel(model)
-        model.setStringList(sorted(EntityCache.types()))
-        self._completerSet = True
+
+    def requestTypes(self):
+        """Ask for the entity types the first time they are needed.
+        Nothing is requested until the credentials have been set.
+        """
+        if self._typesRequested or not hasCredentials():
+            return False
+        self._typesRequested = True
+        self.typesRequested.emit()
         return True
 
+    @QtCore.Slot()
+    def resetTypes(self):
+        """Allow the entity types to be requested again."""
+        self._typesRequested = False
+
+    @QtCore.Slot(list)
+    def setTypes(self, types):
+        """Set the entity types to use for auto completion.
+        The completer is only shown if the user has already interacted
+        with the widget.
+        """
+        self.completer().model().setStringList(types)
+        if self._completionRequested and self.hasFocus():
+            self.completer().complete()
+
     def mousePressEvent(self, event):
         super().mousePressEvent(event)
-        self.setupCompleter()
+        self._completionRequested = True
+        self.requestTypes()
         self.completer().complete()
 
     def keyPressEvent(self, event):
         super().keyPressEvent(event)
-        if self.setupCompleter():
-            self.completer().complete()
+        self._completionRequested = True
+        self.requestTypes()
 
 
 class FTrackExplorer(VFXWindow):
     WindowID = 'ftrack-api-explorer'
     WindowName = 'FTrack API Explorer'
 
-    VisitRole = QtCore.Qt.UserRole
-    DummyRole = QtCore.Qt.UserRole + 1
-    EntityPrimaryKeyRole = QtCore.Qt.UserRole + 2
-    EntityTypeRole = QtCore.Qt.UserRole + 3
-    EntityKeyRole = QtCore.Qt.UserRole + 4
-    AutoPopulateRole = QtCore.Qt.UserRole + 5
+    EntityPrimaryKeyRole = QtCore.Qt.UserRole + 1
+    EntityTypeRole = QtCore.Qt.UserRole + 2
+    EntityKeyRole = QtCore.Qt.UserRole + 3
+    ContainerRole = QtCore.Qt.UserRole + 4
 
     topLevelEntityAdded = QtCore.Signal()
     entityLoading = QtCore.Signal(str, int)
     errorInThread = QtCore.Signal(str, str)
+    entityDataLoaded = QtCore.Signal(object, object)
+    typesLoaded = QtCore.Signal(list)
+    typesFailed = QtCore.Signal()
 
     def __init__(self, parent=None, **kwargs):
         super().__init__(parent=parent, **kwargs)
@@ -309,8 +772,9 @@ class FTrackExplorer(VFXWindow):
         queryLayout.addWidget(queryAll)
 
         self._entityData = QtWidgets.QTreeView()
+        self._entityData.setUniformRowHeights(True)
         layout.addWidget(self._entityData)
-        entityDataModel = QtGui.QStandardItemModel()
+        entityDataModel = EntityModel()
         entityDataModel.setHorizontalHeaderLabels(('Key', 'Value', 'Type'))
         self._entityData.setModel(entityDataModel)
 
@@ -326,16 +790,44 @@ class FTrackExplorer(VFXWindow):
         footer.addStretch()
 
         # Signals
-        self._entityData.expanded.connect(self.populateChildren)
+        self._autoPopulate.toggled.connect(self.autoPopulateToggled)
+        entityDataModel.fetchRequested.connect(self.fetchChildren)
         clear.clicked.connect(self.clear)
-        self.topLevelEntityAdded.connect(self.autoResizeColumns)
+        self._resizeTimer = QtCore.QTimer(self)
+        self._resizeTimer.setSingleShot(True)
+        self._resizeTimer.setInterval(50)
+        self._resizeTimer.timeout.connect(self.autoResizeColumns)
+        self.topLevelEntityAdded.connect(self._resizeTimer.start)
         queryAll.clicked.connect(self.executeAll)
         queryFirst.clicked.connect(self.executeFirst)
 
         self._queryCounter = 0
+        self._partiallyLoaded = []
+        self._cacheLoaded = False
+
+        # Map value types to the methods that create their items
+        # Any subclasses get added the first time they are seen
+        self._itemCreators = {
+            list: self._createContainerItems,
+            tuple: self._createContainerItems,
+            dict: self._createContainerItems,
+            ftrack_api.entity.base.Entity: self._createEntityItems,
+            ftrack_api.collection.Collection: self._createCollectionItems,
+            ftrack_api.collection.KeyValueMappedCollectionProxy: self._createCollectionItems,
+            Placeholders.Collection: self._createCollectionItems,
+            Placeholders.KeyValueMappedCollectionProxy: self._createCollectionItems,
+        }
+
+        # The most common values can skip the base class search
+        for valueType in (str, int, float, bool, type(None), bytes):
+            self._itemCreators[valueType] = self._createValueItems
         self._entityProgress = {}
         self.entityLoading.connect(self.updateEntityProgress)
         self.errorInThread.connect(self.errorPopup)
+        self.entityDataLoaded.connect(self.addEntityData)
+        self._queryText.typesRequested.connect(self.loadTypes)
+        self.typesLoaded.connect(self._queryText.setTypes)
+        self.typesFailed.connect(self._queryText.resetTypes)
 
         # Cache environment info
         # This is so a failed connection can delete a key while still
@@ -353,6 +845,49 @@ class FTrackExplorer(VFXWindow):
         except KeyError:
             self._ftrack_server = 'https://company.ftrackapp.com'
 
+        # Start loading the schema if it's possible to connect
+        self.loadCache()
+        if hasCredentials():
+            self._queryText.requestTypes()
+
+    def closeEvent(self, event):
+        """Stop any queued work when the window is closed."""
+        stopWorkers()
+        closeSessions()
+        self.saveCache()
+        super().closeEvent(event)
+
+    def loadCache(self):
+        """Load any values cached by a previous session.
+        This only happens once the credentials are known, as the cache
+        is saved per server and user.
+        """
+        if self._cacheLoaded or not hasCredentials():
+            return
+        self._cacheLoaded = True
+        self._loadCache()
+
+    @deferred
+    @errorHandler
+    def _loadCache(self):
+        """Load the cache file in a thread."""
+        path = cachePath()
+        if path is not None:
+            EntityCache.loadFromDisk(path)
+
+    def saveCache(self):
+        """Save the cached values for the next session.
+        Remapped IDs are different every time, so the cache is not saved
+        if they have been used.
+        """
+        path = cachePath()
+        if path is None:
+            return
+        if _ID_REMAP:
+            logger.debug('Not saving cache as IDs have been remapped')
+            return
+        EntityCache.saveToDisk(path)
+
     def errorPopup(self, error, exc):
         """Allow error popups to be triggered from threads."""
         msg = QtWidgets.QMessageBox(self)
@@ -399,6 +934,19 @@ class FTrackExplorer(VFXWindow):
         else:
             self._entityProgress[entity][1] = progress
 
+    @deferred
+    @errorHandler
+    def loadTypes(self):
+        """Load the entity types for the query completer."""
+        try:
+            types = EntityCache.typeNames()
+
+        # Allow another attempt once the problem is fixed
+        except Exception:
+            self.typesFailed.emit()
+            raise
+        self.typesLoaded.emit(types)
+
     @deferred
     @errorHandler
     def executeAll(self):
@@ -409,17 +957,22 @@ class FTrackExplorer(VFXWindow):
 
         self.checkCredentials()
 
-        print(f'Executing {query!r}...')
+        logger.info('Executing %r...', query)
         self._queryCounter += 1
         progressName = f'query {self._queryCounter} ({query})'
         self.entityLoading.emit(progressName, -1)
-        with ftrack_api.Session() as session:
-            try:
-                for entity in session.query(query):
-                    self._loadEntity(entity)
-                    time.sleep(0.01)  # Avoid blocking GUI updates
-            except (KeyError, ftrack_api.exception.ServerError):
-                print(f'Invalid query: {query!r}')
+        session = ftrackSession()
+        batch = []
+        try:
+            for entity in session.query(query):
+                batch.append(entity)
+                if len(batch) >= _BATCH_SIZE:
+                    self._addTopLevelEntities(batch)
+                    batch = []
+        except (KeyError, ftrack_api.exception.ServerError):
+            logger.warning('Invalid query: %r', query)
+        if batch:
+            self._addTopLevelEntities(batch)
         self.entityLoading.emit(progressName, 100)
 
     @deferred
@@ -432,18 +985,18 @@ class FTrackExplorer(VFXWindow):
 
         self.checkCredentials()
 
-        print(f'Executing {query!r}...')
+        logger.info('Executing %r...', query)
         self._queryCounter += 1
         progressName = f'query {self._queryCounter}: ({query})'
         self.entityLoading.emit(progressName, 0)
-        with ftrack_api.Session() as session:
-            try:
-                entity = session.query(query).first()
-            except (KeyError, ftrack_api.exception.ServerError):
-                print(f'Invalid query: {query!r}')
-            else:
-                if entity is not None:
-                    self._loadEntity(entity)
+        session = ftrackSession()
+        try:
+            entity = session.query(query).first()
+        except (KeyError, ftrack_api.exception.ServerError):
+            logger.warning('Invalid query: %r', query)
+        else:
+            if entity is not None:
+                self._loadEntity(entity)
         self.entityLoading.emit(progressName, 100)
 
     @QtCore.Slot()
@@ -455,54 +1008,62 @@ class FTrackExplorer(VFXWindow):
     def clear(self):
         """Remove all the data."""
         self._entityData.model().removeRows(0, self._entityData.model().rowCount())
+        self._partiallyLoaded = []
         EntityCache.reset()
 
     @QtCore.Slot(QtCore.QModelIndex)
-    def populateChildren(self, index=None):
+    def fetchChildren(self, index):
         """Load all child items when an entity is expanded."""
         model = self._entityData.model()
 
-        # Check if the items have already been populated
-        if model.data(index, self.VisitRole) is not None:
-            populated = model.data(index, self.AutoPopulateRole)
-
-            # Load the remaining entity keys if required
-            # The EntityKeyRole check is to avoid reloading collections
-            if not populated and self.autoPopulate() and not model.data(index, self.EntityKeyRole):
-                parentType = model.data(index, self.EntityTypeRole)
-                parentPrimaryKeys = model.data(index, self.EntityPrimaryKeyRole).split(';')
-                item = model.itemFromIndex(index)
-                loaded = [item.child(row).text() for row in range(item.rowCount())]
-                self.loadEntity(parentType, parentPrimaryKeys, parent=item, _loaded=loaded)
-                model.setData(index, True, self.AutoPopulateRole)
-
-        # Mark the item as visited
-        elif model.data(index, self.DummyRole) is not None:
-            model.setData(index, True, self.VisitRole)
-            model.setData(index, self.autoPopulate(), self.AutoPopulateRole)
-            item = model.itemFromIndex(index)
-
-            # Remove the dummy item
-            model.removeRow(0, index)
-
-            # Populate with entities
-            parentType = model.data(index, self.EntityTypeRole)
-            parentPrimaryKeys = model.data(index, self.EntityPrimaryKeyRole).split(';')
-            childKey = model.data(index, self.EntityKeyRole)
-            self.loadEntity(parentType, parentPrimaryKeys, key=childKey, parent=item)
+        # Lists and dicts already have their values so can be added now
+        container = model.data(index, self.ContainerRole)
+        if container is not None:
+            values = [(None, k, v, container.entity) for k, v in container.items()]
+            self.addEntityData(QtCore.QPersistentModelIndex(index), values)
+            return
+
+        item = model.itemFromIndex(index)
+        parentType = model.data(index, self.EntityTypeRole)
+        parentPrimaryKeys = model.data(index, self.EntityPrimaryKeyRole)
+        childKey = model.data(index, self.EntityKeyRole)
+
+        # Remember which entities were only loaded from cache
+        # The EntityKeyRole check is to avoid reloading collections
+        if not self.autoPopulate() and not childKey:
+            self._partiallyLoaded.append(QtCore.QPersistentModelIndex(index))
+
+        loaded = [item.child(row).text() for row in range(item.rowCount())]
+        parent = QtCore.QPersistentModelIndex(index)
+        self.loadEntity(parentType, parentPrimaryKeys, key=childKey, parent=parent, _loaded=loaded)
+
+    @QtCore.Slot(bool)
+    def autoPopulateToggled(self, enabled):
+        """Allow the remaining entity keys to be loaded on expand."""
+        if not enabled:
+            return
+        model = self._entityData.model()
+        for index in self._partiallyLoaded:
+            item = model.itemFromPersistentIndex(index)
+            if item is not None:
+                item.setData(True, model.UnloadedRole)
+        self._partiallyLoaded = []
 
     @QtCore.Slot()
     def autoResizeColumns(self):
         """Resize the columns to fit the contents.
         This can only be called outside of a thread, otherwise this appears:
         QBasicTimer::start: QBasicTimer can only be used with threads started with QThread
+
+        It is triggered by a timer so that adding many top level items
+        at once only causes a single resize.
         """
         self._entityData.resizeColumnToContents(0)
         self._entityData.setColumnWidth(1, self._entityData.columnWidth(0))
         self._entityData.resizeColumnToContents(2)
         try:
-            self.topLevelEntityAdded.disconnect(self.autoResizeColumns)
-        except RuntimeError:
+            self.topLevelEntityAdded.disconnect(self._resizeTimer.start)
+        except (RuntimeError, TypeError):
             pass
 
     def checkCredentials(self):
@@ -524,140 +1085,179 @@ class FTrackExplorer(VFXWindow):
         createPopup('FTRACK_SERVER', 'server address', self._ftrack_server)
         createPopup('FTRACK_API_KEY', 'API Key', self._ftrack_api_key)
         createPopup('FTRACK_API_USER', 'username', self._ftrack_api_user)
+        self.loadCache()
 
     @deferred
     @errorHandler
     def loadEntity(self, entityType, entityID, key=None, parent=None, _loaded=None):
-        """Wrap the load function to allow multiple entities to be added."""
-        session = None
-
-        # Only start a session if not loading cached data
+        """Wrap the load function to allow multiple entities to be added.
+        The entity type is the class of a previously loaded entity.
+        """
+        # Only use a session if not loading cached data
         if self.autoPopulate():
-            session = ftrack_api.Session()
+            session = ftrackSession()
+            typeName = TypeInfo.get(entityType).name
 
             # Build a list of potential entities
             if entityID:
-                entity = session.get(entityType, entityID)
+                entity = session.get(typeName, entityID)
                 if entity is None:
-                    print(f'Could not find entity.')
+                    logger.warning('Could not find entity.')
                     entities = []
                 else:
-                    entities = [entityID]
+                    entities = [entity]
             else:
-                entities = session.query(entityType)
-
-            # Load anything not yet loaded
-            for i, entity in enumerate(entities):
-                if not isinstance(entity, ftrack_api.entity.base.Entity):
-                    entities[i] = session.get(entityType, entityID)
+                entities = session.query(typeName)
 
         # Load entity from cache
         else:
-            name = entityRepr(EntityCache.types()[entityType], entityID, remapIDs=self.remapIDs())
+            name = entityRepr(entityType, entityID, remapIDs=self.remapIDs())
             entity = EntityCache.entity(name)
-            if entity is not None:
+            if entity is None:
+                entities = []
+            else:
+                # Cache anything the entity has already loaded
+                EntityCache.load(entity, remapIDs=self.remapIDs())
                 entities = [entity]
 
         # Add each entity to the GUI
+        found = False
         for entity in entities:
+            found = True
             try:
                 self._loadEntity(entity, key=key, parent=parent, _loaded=_loaded)
             # The GUI has likely refreshed so we can stop the query here
             except RuntimeError:
                 break
 
-        if session is not None:
-            session.close()
+        # Let the parent know there is nothing to load
+        if not found and parent is not None:
+            self.entityDataLoaded.emit(parent, [])
+
+    def _addTopLevelEntities(self, entities):
+        """Add new FTrack entities as top level items.
+        The rows are sent to the GUI thread in a single batch, and none
+        of the keys are loaded as we don't want to force load everything.
+        """
+        remapIDs = self.remapIDs()
+        for entity in entities:
+            EntityCache.load(entity, remapIDs=remapIDs)
+            logger.info('Found %s', entityRepr(entity, remapIDs=remapIDs))
+        self.entityDataLoaded.emit(None, [(None, None, entity, entity) for entity in entities])
+        self.topLevelEntityAdded.emit()
 
     def _loadEntity(self, entity, key=None, parent=None, _loaded=None):
         """Add a new FTrack entity.
         Optionally set key to load a child entity.
+
+        This is designed to run in a thread, so the values are sent to
+        the GUI thread to be added to the model.
         """
+        # Add a new top level item
+        if parent is None:
+            self._addTopLevelEntities([entity])
+            return
+
         if _loaded is None:
             _loaded = []
         else:
-            _loaded = list(sorted(_loaded))
+            _loaded = sorted(_loaded)
+
+        # Keep a set for fast lookups while the sorted list is updated
+        loadedKeys = set(_loaded)
 
         cache = EntityCache(entity, remapIDs=self.remapIDs())
         name = cache.id
-        attributes = type(entity).attributes
-
-        # Add a new top level item
-        if parent is None:
-            root = self._entityData.model().invisibleRootItem()
-            parent = self.addItem(root, None, entity, entity)
-            self.topLevelEntityAdded.emit()
-            print(f'Found {name}')
-            EntityCache.load(entity, remapIDs=self.remapIDs())
-
-            # Stop here as we don't want to force load everything
-            return
+        info = TypeInfo.get(type(entity))
 
         if key:
-            print(f'Loading data for {key!r}...')
+            logger.debug('Loading data for %r...', key)
         else:
-            print(f'Loading data for {name}...')
+            logger.debug('Loading data for %s...', name)
 
-        # Allow individual keys to be loaded
+        # Load a collection from its key
+        # Referenced entities are loaded from their own items instead
         if key:
-            self.entityLoading.emit(f'{name}[{key!r}]', 0)
-            attr = attributes.get(key)
-
-            # Load entities
-            if isinstance(attr, ftrack_api.attribute.ReferenceAttribute):
-                entity = entity[key]
-
-            # Load collections
+            progressName = f'{name}[{key!r}]'
+            emitProgress = self.entityLoading.emit
+            emitProgress(progressName, 0)
+
+            kind = info.kinds.get(key)
+            value = entity[key]
+            if kind == TypeInfo.Collection:
+                items = [(None, v) for v in value]
+            elif kind == TypeInfo.MappedCollection:
+                items = [(k, value[k]) for k in sorted(value)]
             else:
-                value = entity[key]
-                total_values = len(value)
-                if isinstance(attr, ftrack_api.attribute.CollectionAttribute):
-                    for i, v in enumerate(value):
-                        self.entityLoading.emit(f'{name}[{key!r}]', int(100 * i / total_values))
-                        self.addItem(parent, None, v, v)
-
-                elif isinstance(attr, ftrack_api.attribute.KeyValueMappedCollectionAttribute):
-                    for i, (k, v) in enumerate(sorted(value.items())):
-                        self.entityLoading.emit(f'{name}[{key!r}]', int(100 * i / total_values))
-                        self.addItem(parent, k, v, v)
-
-                self.entityLoading.emit(f'{name}[{key!r}]', 100)
-                print(f'Finished loading {key!r} collection')
-                return
+                items = []
+
+            total_values = len(items)
+            step = _progressStep(total_values)
+            rows = []
+            for i, (k, v) in enumerate(items):
+                if not i % step:
+                    emitProgress(progressName, int(100 * i / total_values))
+                rows.append((None, k, v, v))
+
+            self.entityDataLoaded.emit(parent, rows)
+            emitProgress(progressName, 100)
+            logger.debug('Finished loading %r collection', key)
+            return
 
         # Load all keys
-        keys = set(entity.keys())
+        keys = info.sortedKeys
+
+        # Fetch everything not yet loaded in a single query
+        # If it fails then each key will be individually read instead
+        # Values from a previous session are refetched once they expire
+        autoPopulate = self.autoPopulate()
+        stale = set()
+        if autoPopulate:
+            if EntityCache.CacheTimes:
+                stale = {k for k in keys if cache.isExpired(k)}
+            missing = [k for k in keys if k not in loadedKeys and (k in stale or k not in cache)]
+            if not populateKeys(entity, missing):
+                logger.debug('Failed to read all keys of %s', name)
+
+        # Bind anything used in the loop to avoid repeated lookups
+        emitProgress = self.entityLoading.emit
+        getKind = info.kinds.get
+        getCached = cache.get
+        notSet = ftrack_api.symbol.NOT_SET
 
         # Load a new entity
         total_keys = len(keys)
-        for i, key in enumerate(sorted(keys)):
-            self.entityLoading.emit(name, int(100 * i / total_keys))
+        step = _progressStep(total_keys)
+        rows = []
+        for i, key in enumerate(keys):
+            if not i % step:
+                emitProgress(name, int(100 * i / total_keys))
 
-            if key in _loaded:
+            if key in loadedKeys:
                 continue
 
             # Load cached value
-            if key in cache:
-                value = cache[key]
-                print(f'Read {key!r} from cache...')
+            value = notSet if key in stale else getCached(key, notSet)
+            if value is not notSet:
+                logger.debug('Read %r from cache...', key)
 
             # Fetch from server
-            elif self.autoPopulate():
-                print(f'Reading {key!r}...')
+            elif autoPopulate:
+                logger.debug('Reading %r...', key)
 
                 # Avoid loading non scalar types at this stage
-                attr = attributes.get(key)
-                if isinstance(attr, ftrack_api.attribute.CollectionAttribute):
+                kind = getKind(key)
+                if kind == TypeInfo.Collection:
                     value = Placeholders.Collection()
 
-                elif isinstance(attr, ftrack_api.attribute.KeyValueMappedCollectionAttribute):
+                elif kind == TypeInfo.MappedCollection:
                     value = Placeholders.KeyValueMappedCollectionProxy()
 
                 else:
                     try:
                         value = entity[key]
                     except ftrack_api.exception.ServerError:
-                        print(f'Failed to read {key!r}')
+                        logger.warning('Failed to read %r', key)
                         continue
                     else:
                         cache[key] = value
@@ -667,90 +1267,137 @@ class FTrackExplorer(VFXWindow):
             # Insert in alphabetical order
             row = None
             if _loaded:
-                for i, k in enumerate(_loaded):
-                    if k > key:
-                        row = i
-                        _loaded.insert(i, key)
-                        break
+                row = bisect.bisect_left(_loaded, key)
+                _loaded.insert(row, key)
 
-            self.addItem(parent, key, value, entity, row=row)
-        self.entityLoading.emit(name, 100)
-        print(f'Finished reading data from {name}')
+            rows.append((row, key, value, entity))
 
-    def appendRow(self, parent, entityKey, entityValue='', entityType='', row=None):
+        self.entityDataLoaded.emit(parent, rows)
+        emitProgress(name, 100)
+        logger.debug('Finished reading data from %s', name)
+
+    def createRow(self, entityKey, entityValue='', entityType=''):
         """Create a new row of QStandardItems."""
         if self.remapIDs():
             entityValue = remapID(entityValue)
+        return [QtGui.QStandardItem(entityKey), QtGui.QStandardItem(entityValue), QtGui.QStandardItem(entityType)]
+
+    def insertRows(self, parent, rows):
+        """Add multiple rows of items to a parent item.
+        The rows are built up front so that the model only gets updated
+        once all the slow server requests have finished.
+
+        Parameters:
+            parent (QStandardItem): Parent item to insert into.
+            rows (list): List of (row, items) pairs.
+                If the row is None then the items will be appended.
+        """
+        for row, items in rows:
+            if row is None:
+                parent.appendRow(items)
+            else:
+                parent.insertRow(row, items)
+
+    @QtCore.Slot(object, object)
+    def addEntityData(self, parent, values):
+        """Add values loaded from a thread to the model.
 
-        item = QtGui.QStandardItem(entityKey)
-        data = (item, QtGui.QStandardItem(entityValue), QtGui.QStandardItem(entityType))
-        if row is None:
-            parent.appendRow(data)
+        Parameters:
+            parent (QPersistentModelIndex): Index to add the values to.
+                If None then top level items will be created.
+            values (list): List of (row, key, value, entity) items.
+                See `createItems` for more details.
+        """
+        model = self._entityData.model()
+        if parent is None:
+            parentItem = model.invisibleRootItem()
         else:
-            parent.insertRow(row, data)
-        return item
+            parentItem = model.itemFromPersistentIndex(parent)
+
+            # The item was removed while the data was loading
+            if parentItem is None:
+                return
 
-    def addItem(self, parent, key, value, entity, row=None):
-        """Add an FTrack entity value.
+        rows = [(row, self.createItems(key, value, entity)) for row, key, value, entity in values]
+
+        # Only repaint the view once all the rows have been added
+        self._entityData.setUpdatesEnabled(False)
+        try:
+            self.insertRows(parentItem, rows)
+        finally:
+            self._entityData.setUpdatesEnabled(True)
+
+        # Fall back to the real row count now the item is loaded
+        if parent is not None:
+            parentItem.setData(None, EntityModel.UnloadedRole)
+
+    def createItems(self, key, value, entity):
+        """Create a row of items for an FTrack entity value.
+        Any child items or data are set before the row is inserted into
+        the model, so that building them doesn't trigger model updates.
 
         Parameters:
-            parent (QStandardItem): Parent item to append to.
             key (str): The key used to access the current entity.
             value (object): Value belonging to entity['key'].
             entity (Entity): Parent entity.
-                This is used with the dummy items so that the child
+                This is used with the unloaded items so that the child
                 entity can easily be queried later.
         """
-        className = type(value).__name__
-
-        if isinstance(value, (list, tuple)):
-            child = self.appendRow(parent, key, '', className, row=row)
-            for i, v in enumerate(value):
-                k = str(i)
-                self.addItem(child, k, v, entity)
-
-        elif isinstance(value, dict):
-            child = self.appendRow(parent, key, '', className, row=row)
-            for k, v in sorted(value.items()):
-                self.addItem(child, k, v, entity)
-
-        elif isinstance(value, ftrack_api.entity.base.Entity):
-            entityStr = entityRepr(value, remapIDs=self.remapIDs())
-            if key is None:
-                key, entityStr = entityStr, ''
-            child = self.appendRow(parent, key, entityStr, type(value).entity_type, row=row)
-            self.addDummyItem(child, value, '')
-
-        elif isinstance(value, (ftrack_api.collection.Collection, Placeholders.Collection)):
-            child = self.appendRow(parent, key, '', className, row=row)
-            self.addDummyItem(child, entity, key)
-
-        elif isinstance(value, (ftrack_api.collection.KeyValueMappedCollectionProxy,
-                                Placeholders.KeyValueMappedCollectionProxy)):
-            child = self.appendRow(parent, key, '', className, row=row)
-            self.addDummyItem(child, entity, key)
-
-        else:
-            child = self.appendRow(parent, key, str(value), className, row=row)
-        return child
-
-    def addDummyItem(self, parent, entity, key):
-        """Create a dummy item for things not yet loaded."""
-        model = self._entityData.model()
+        valueType = type(value)
+        try:
+            creator = self._itemCreators[valueType]
 
+        # Find the creator from the base classes and remember it
+        except KeyError:
+            creator = self._createValueItems
+            for baseType, baseCreator in list(self._itemCreators.items()):
+                if issubclass(valueType, baseType):
+                    creator = baseCreator
+                    break
+            self._itemCreators[valueType] = creator
+
+        return creator(key, value, entity)
+
+    def _createContainerItems(self, key, value, entity):
+        """Create a row of items for a list, tuple or dict.
+        The children are only created once the item is expanded.
+        """
+        items = self.createRow(key, '', type(value).__name__)
+        if value:
+            items[0].setData(True, EntityModel.UnloadedRole)
+            items[0].setData(ContainerValue(value, entity), self.ContainerRole)
+        return items
+
+    def _createEntityItems(self, key, value, entity):
+        """Create a row of items for an entity to load on expand."""
+        entityStr = entityRepr(value, remapIDs=self.remapIDs())
+        if key is None:
+            key, entityStr = entityStr, ''
+        items = self.createRow(key, entityStr, type(value).entity_type)
+        self.markUnloaded(items[0], value, '')
+        return items
+
+    def _createCollectionItems(self, key, value, entity):
+        """Create a row of items for a collection to load on expand."""
+        items = self.createRow(key, '', type(value).__name__)
+        self.markUnloaded(items[0], entity, key)
+        return items
+
+    def _createValueItems(self, key, value, entity):
+        """Create a row of items for any other value."""
+        return self.createRow(key, str(value), type(value).__name__)
+
+    def markUnloaded(self, item, entity, key):
+        """Mark an item as having children not yet loaded."""
         # Store data about the parent entities
-        primary_key_attributes = type(entity).primary_key_attributes
-        parentIndex = model.indexFromItem(parent)
-        model.setData(parentIndex, True, self.DummyRole)
-        model.setData(parentIndex, str(key), self.EntityKeyRole)
-        model.setData(parentIndex, str(entity.__class__.__name__), self.EntityTypeRole)
-        model.setData(parentIndex, ';'.join(str(entity[k]) for k in map(str, primary_key_attributes)), self.EntityPrimaryKeyRole)
-
-        # Create the dummy item
-        item = QtGui.QStandardItem('<not loaded>')
-        parent.appendRow(item)
-        return item
+        # This is set on the item so it works before it's added to the model
+        entityType = type(entity)
+        item.setData(True, EntityModel.UnloadedRole)
+        item.setData(str(key), self.EntityKeyRole)
+        item.setData(entityType, self.EntityTypeRole)
+        item.setData(tuple(entity[k] for k in TypeInfo.get(entityType).primaryKeys), self.EntityPrimaryKeyRole)
 
 
 if __name__ == '__main__':
+    logging.basicConfig()
     FTrackExplorer.show()